@@ -1,101 +1,109 @@
 import argparse
-import json
 import logging
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
 import prometheus_client
 import requests
+import urllib3
 
-from prometheus_client import start_http_server, Gauge
+from prometheus_client import start_http_server
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+from requests.adapters import HTTPAdapter
 
 BASEURL = "https://osu.ppy.sh"
 API_PATH = "/api/v2"
 API_URL = f"{BASEURL}{API_PATH}"
-
-prometheus_client.REGISTRY.unregister(prometheus_client.PROCESS_COLLECTOR)
-prometheus_client.REGISTRY.unregister(prometheus_client.PLATFORM_COLLECTOR)
-prometheus_client.REGISTRY.unregister(prometheus_client.GC_COLLECTOR)
+MAX_CONCURRENT_REQUESTS = 4
+MAX_BACKOFF_SECONDS = 300
 
 labels = ["user_id", "username"]
-gauges = {
-	"total_hits": Gauge(
+metrics = {
+	"total_hits": (
 		"osu_total_hitobjects_hit",
-		"Total number of hitobjects hit by the user on maps with a leaderboard.",
-		labels
+		"Total number of hitobjects hit by the user on maps with a leaderboard."
 	),
-	"play_count": Gauge(
+	"play_count": (
 		"osu_playcount",
-		"Number of plays done by the user, including fails and retries, on a map with a leaderboard.",
-		labels
+		"Number of plays done by the user, including fails and retries, on a map with a leaderboard."
 	),
-	"ranked_score": Gauge(
+	"ranked_score": (
 		"osu_ranked_score",
-		"Total of every best score achieved by the user on a map with a leaderboard.",
-		labels
+		"Total of every best score achieved by the user on a map with a leaderboard."
 	),
-	"total_score": Gauge(
+	"total_score": (
 		"osu_total_score",
-		"Total of every score achieved by the user on a map with a leaderboard.",
-		labels
+		"Total of every score achieved by the user on a map with a leaderboard."
 	),
-	"global_rank": Gauge(
+	"global_rank": (
 		"osu_rank",
-		"Rank of the user on the global pp leaderboard.",
-		labels
+		"Rank of the user on the global pp leaderboard."
 	),
-	"country_rank": Gauge(
+	"country_rank": (
 		"osu_rank_country",
-		"Rank of the user on the country-based pp leaderboard.",
-		labels
+		"Rank of the user on the country-based pp leaderboard."
 	),
-	"level": Gauge(
+	"level": (
 		"osu_level",
-		"The level of the user.",
-		labels
+		"The level of the user."
 	),
-	"pp": Gauge(
+	"pp": (
 		"osu_pp",
-		"The pp score of the user.",
-		labels
+		"The pp score of the user."
 	),
-	"hit_accuracy": Gauge(
+	"hit_accuracy": (
 		"osu_accuracy",
-		"The accuracy of the user averaged over all plays, better plays are weighted more (like with pp).",
-		labels
+		"The accuracy of the user averaged over all plays, better plays are weighted more (like with pp)."
 	),
-	"grade_counts_ss": Gauge(
+	"grade_counts_ss": (
 		"osu_ss_count",
-		"The number of SS plays achieved by the user.",
-		labels
+		"The number of SS plays achieved by the user."
 	),
-	"grade_counts_ssh": Gauge(
+	"grade_counts_ssh": (
 		"osu_ss_modded_count",
-		"The number of modded SS plays achieved by the user.",
-		labels
+		"The number of modded SS plays achieved by the user."
 	),
-	"grade_counts_s": Gauge(
+	"grade_counts_s": (
 		"osu_s_count",
-		"The number of S plays achieved by the user.",
-		labels
+		"The number of S plays achieved by the user."
 	),
-	"grade_counts_sh": Gauge(
+	"grade_counts_sh": (
 		"osu_s_modded_count",
-		"The number of modded S plays achieved by the user.",
-		labels
+		"The number of modded S plays achieved by the user."
 	),
-	"grade_counts_a": Gauge(
+	"grade_counts_a": (
 		"osu_a_count",
-		"The number of A plays achieved by the user.",
-		labels
+		"The number of A plays achieved by the user."
 	),
-	"play_time": Gauge(
+	"play_time": (
 		"osu_total_seconds_played",
-		"The total number of seconds the user was actively playing a map.",
-		labels
+		"The total number of seconds the user was actively playing a map."
 	),
 }
 
 
+class UserStatsCollector(Collector):
+	def __init__(self, metrics):
+		self.metrics = metrics
+		# Current value per metric key and (user_id, username), only turned into samples on scrape
+		self.values = {key: {} for key in metrics}
+
+	def describe(self):
+		for name, documentation in self.metrics.values():
+			yield GaugeMetricFamily(name, documentation, labels=labels)
+
+	def collect(self):
+		for key, (name, documentation) in self.metrics.items():
+			family = GaugeMetricFamily(name, documentation, labels=labels)
+			# Copy the items, the update loop may modify them while a scrape is running
+			for (user_id, username), value in list(self.values[key].items()):
+				family.add_metric([str(user_id), username], value)
+			yield family
+
+
 class ErrorTracker:
 	def __init__(self, max_intervals_with_errors):
 		self.intervals_with_errors = 0
@@ -112,9 +120,51 @@ class ErrorTracker:
 		self.intervals_with_errors = 0
 
 
-def get_token(config):
-	response = requests.post(
+class UserBackoff:
+	def __init__(self, refresh_interval_seconds):
+		self.refresh_interval_seconds = refresh_interval_seconds
+		# Skipping a user for less than one interval would not skip anything
+		self.max_backoff_seconds = max(MAX_BACKOFF_SECONDS, refresh_interval_seconds)
+		# Per user id: (number of consecutive failures, monotonic time before which the user is skipped)
+		self.user_state = {}
+
+	def is_blocked(self, user_id, now):
+		return now < self.user_state.get(user_id, (0, 0))[1]
+
+	def process_failure(self, user_id, retry_after=None):
+		fails = self.user_state.get(user_id, (0, 0))[0] + 1
+		if retry_after is not None and retry_after.isdigit():
+			delay = int(retry_after)
+		else:
+			delay = min(self.max_backoff_seconds, self.refresh_interval_seconds * 2 ** (fails - 1))
+		self.user_state[user_id] = (fails, time.monotonic() + delay)
+		return delay
+
+	def reset(self, user_id):
+		self.user_state.pop(user_id, None)
+
+
+def load_config(path):
+	# orjson parses bytes directly, no need to decode the file first
+	with open(path, "rb") as fh:
+		return orjson.loads(fh.read())
+
+
+def create_session(pool_size):
+	session = requests.Session()
+	session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+	return session
+
+
+def authenticate(session, config):
+	session.headers["Authorization"] = f"Bearer {get_token(session, config)}"
+
+
+def get_token(session, config):
+	response = session.post(
 		f"{BASEURL}/oauth/token",
+		# Do not send a possibly stale bearer token along with the token request
+		headers={"Authorization": None},
 		json={
 			"client_id": config["client_id"],
 			"client_secret": config["client_secret"],
@@ -126,16 +176,124 @@ def get_token(config):
 	if response.status_code != 200:
 		raise ValueError("Failed to fetch token.")
 
-	return response.json()["access_token"]
+	return orjson.loads(response.content)["access_token"]
+
+
+def get_user_url(user_id):
+	return f"{API_URL}/users/{user_id}/osu"
 
 
-def request_user_data(access_token, user_id):
-	response = requests.get(
-		f"{API_URL}/users/{user_id}/osu",
-		headers={"Authorization": f"Bearer {access_token}"},
-		params={"key": "id"}
+def request_user_data(session, url):
+	response = session.get(
+		url,
+		params={"key": "id"},
+		stream=True
 	)
-	return response
+	try:
+		# Read the body straight from urllib3 instead of letting requests buffer it chunk by chunk first
+		body = response.raw.read(decode_content=True)
+	finally:
+		response.close()
+	return response, body
+
+
+def request_users_data(session, executor, user_urls):
+	futures = {user_id: executor.submit(request_user_data, session, url) for user_id, url in user_urls.items()}
+
+	# Collect failures per user, so one failed request does not discard the responses of the others
+	responses = {}
+	errors = {}
+	for user_id, future in futures.items():
+		try:
+			responses[user_id] = future.result()
+		except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+			errors[user_id] = e
+
+	return responses, errors
+
+
+def update_metrics(session, executor, config, user_urls, collector, error_tracker, backoff):
+	now = time.monotonic()
+	user_urls = {user_id: url for user_id, url in user_urls.items() if not backoff.is_blocked(user_id, now)}
+
+	responses, errors = request_users_data(session, executor, user_urls)
+
+	unauthorized = [user_id for user_id, (response, _) in responses.items() if response.status_code == 401]
+	if unauthorized:
+		# Token probably invalid, refresh and retry
+		logging.warning("Authentication failed, trying new token...")
+		try:
+			authenticate(session, config)
+		except requests.RequestException as e:
+			error_tracker.process_error(f"Exception on token request, aborting update: {e}")
+			return
+
+		for user_id in unauthorized:
+			del responses[user_id]
+		retried_responses, retry_errors = request_users_data(
+			session,
+			executor,
+			{user_id: user_urls[user_id] for user_id in unauthorized}
+		)
+		responses.update(retried_responses)
+		errors.update(retry_errors)
+
+	# Skip only the users that are still denied, the other responses are applied below
+	denied = [user_id for user_id, (response, _) in responses.items() if response.status_code == 401]
+	for user_id in denied:
+		del responses[user_id]
+
+	for user_id, (response, body) in responses.items():
+		if response.status_code != 200:
+			delay = backoff.process_failure(user_id, response.headers.get("Retry-After"))
+			logging.warning(
+				f"Failed to fetch user info for user id {user_id}, skipping it for {delay} seconds: "
+				f"{response.status_code} - {body.decode('utf-8', 'replace')}"
+			)
+			continue
+
+		backoff.reset(user_id)
+
+		data = orjson.loads(body)
+		stats = data["statistics"]
+		user = (data["id"], data["username"])
+		grade_counts = stats.get("grade_counts", {})
+		level = stats["level"]["current"]
+
+		for key, values in collector.values.items():
+			if key.startswith("grade_counts_"):
+				value = grade_counts.get(key[len("grade_counts_"):])
+			elif key == "level":
+				value = level
+			else:
+				value = stats.get(key)
+
+			if value is None:
+				values.pop(user, None)
+			elif values.get(user) != value:
+				# Most statistics do not change between polls, only write the ones that did
+				values[user] = value
+
+		logging.info(f"Update for user {data['username']} ({user_id}) completed.")
+
+	for user_id, e in errors.items():
+		delay = backoff.process_failure(user_id)
+		logging.warning(f"Exception on user data request for user id {user_id}, skipping it for {delay} seconds: {e}")
+
+	failures = []
+	if denied:
+		failures.append(
+			f"authentication still denied after fetching new token for user ids {', '.join(str(user_id) for user_id in denied)}"
+		)
+	if errors:
+		failures.append(f"user data requests failed for user ids {', '.join(str(user_id) for user_id in errors)}")
+
+	if failures:
+		error_tracker.process_error(f"Errors during update: {'; '.join(failures)}.")
+	elif any(response.status_code == 200 for response, _ in responses.values()):
+		# Only count consecutive intervals with errors. An interval that skipped all failing users
+		# through backoff fetched nothing and leaves the count alone.
+		error_tracker.reset()
 
 
 def main():
@@ -148,61 +306,45 @@ def main():
 	args = parser.parse_args()
 
 	logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
-	with open(args.config, "r") as fh:
-		config = json.load(fh)
+	config = load_config(args.config)
 
 	error_tracker = ErrorTracker(config["max_intervals_with_errors"])
+	backoff = UserBackoff(config["refresh_interval_seconds"])
+	user_urls = {user_id: get_user_url(user_id) for user_id in config["user_ids"]}
+
+	prometheus_client.REGISTRY.unregister(prometheus_client.PROCESS_COLLECTOR)
+	prometheus_client.REGISTRY.unregister(prometheus_client.PLATFORM_COLLECTOR)
+	prometheus_client.REGISTRY.unregister(prometheus_client.GC_COLLECTOR)
+
+	allowlist = config.get("metrics_allowlist")
+	if allowlist is not None:
+		unknown = set(allowlist) - metrics.keys()
+		if unknown:
+			raise ValueError(f"Unknown metrics in metrics_allowlist: {', '.join(sorted(unknown))}")
+	collector = UserStatsCollector({
+		key: metric for key, metric in metrics.items() if allowlist is None or key in allowlist
+	})
+	prometheus_client.REGISTRY.register(collector)
 
 	start_http_server(config["port"], config["host"])
-	access_token = get_token(config)
+	# One pooled connection per worker, so every concurrent request can reuse a kept-alive connection
+	max_concurrent_requests = config.get("max_concurrent_requests", MAX_CONCURRENT_REQUESTS)
+	session = create_session(max_concurrent_requests)
+	authenticate(session, config)
+	executor = ThreadPoolExecutor(max_workers=max_concurrent_requests)
 
+	next_tick = time.monotonic()
 	while True:
-		for user_id in config["user_ids"]:
-			try:
-				response = request_user_data(access_token, user_id)
-			except requests.RequestException as e:
-				error_tracker.process_error(f"Exception on user data request, aborting update: {e}")
-				break
-
-			if response.status_code == 401:
-				# Token probably invalid, refresh and retry
-				logging.warning("Authentication failed, trying new token...")
-				access_token = get_token(config)
-				response = request_user_data(access_token, user_id)
-
-				if response.status_code == 401:
-					error_tracker.process_error(f"Authentication still denied after fetching new token. Aborting update.")
-					break
-
-			if response.status_code != 200:
-				logging.warning(
-					f"Failed to fetch user info for user id {user_id}: "
-					f"{response.status_code} - {response.content.decode('utf-8')}"
-				)
-				continue
-
-			# Convert stats to workable format
-			data = response.json()
-			stats = data["statistics"]
-			stats["level"] = stats["level"]["current"]
-			for key, value in stats["grade_counts"].items():
-				stats[f"grade_counts_{key}"] = value
-
-			for key, value in stats.items():
-				if key not in gauges:
-					continue
-
-				if value is None:
-					# Check if labelset exists, remove it if found
-					for sample in gauges[key].collect()[0].samples:
-						if sample.labels == {"user_id": str(data["id"]), "username": data["username"]}:
-							gauges[key].remove(data["id"], data["username"])
-				else:
-					gauges[key].labels(user_id=data["id"], username=data["username"]).set(value)
-
-			logging.info(f"Update for user {data['username']} ({user_id}) completed.")
-
-		time.sleep(config["refresh_interval_seconds"])
+		update_metrics(session, executor, config, user_urls, collector, error_tracker, backoff)
+
+		# Schedule against the previous tick so the update duration does not add up to the interval
+		next_tick += config["refresh_interval_seconds"]
+		sleep_for = next_tick - time.monotonic()
+		if sleep_for > 0:
+			time.sleep(sleep_for)
+		else:
+			# The update took longer than the interval, start over from now instead of catching up
+			next_tick = time.monotonic()
 
 
 if __name__ == "__main__":